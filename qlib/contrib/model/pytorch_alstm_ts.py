@@ -5,19 +5,22 @@
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from typing import Text, Union
-import copy
 from ...utils import get_or_create_path
 from ...log import get_module_logger
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 
 from .pytorch_utils import count_parameters
 from ...model.base import Model
@@ -27,6 +30,12 @@ from ...model.utils import ConcatDataset
 from ...data.dataset.weight import Reweighter
 
 
+def _save_and_log(state_dict, path, recorder):
+    torch.save(state_dict, path)
+    if recorder is not None:
+        recorder.log_artifact(path, artifact_path="models")
+
+
 class ALSTM(Model):
     """ALSTM Model
 
@@ -57,7 +66,12 @@ class ALSTM(Model):
         optimizer="adam",
         n_jobs=10,
         GPU=0,
+        distributed=False,
         seed=None,
+        deterministic=False,
+        compile=False,
+        amp_dtype="bfloat16",
+        save_every_epoch=False,
         init_model_path=None,
         **kwargs,
     ):
@@ -79,7 +93,26 @@ class ALSTM(Model):
         self.loss = loss
         self.device = torch.device("cuda:%d" % (GPU) if torch.cuda.is_available() and GPU >= 0 else "mps" if torch.backends.mps.is_available() else "cpu")
         self.n_jobs = n_jobs
+        self.distributed = distributed
+        self._rank, self._world_size = 0, 1
+        if self.distributed:
+            # launched via torchrun; one process per GPU
+            if not dist.is_initialized():
+                dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+            self._rank = dist.get_rank()
+            self._world_size = dist.get_world_size()
+            if torch.cuda.is_available():
+                local_rank = int(os.environ.get("LOCAL_RANK", self._rank))
+                torch.cuda.set_device(local_rank)
+                self.device = torch.device("cuda:%d" % local_rank)
         self.seed = seed
+        self.deterministic = deterministic
+        self.compile = compile
+        self.amp_dtype = getattr(torch, amp_dtype) if isinstance(amp_dtype, str) else amp_dtype
+        self._use_amp = self.device.type == "cuda" and self.amp_dtype in (torch.float16, torch.bfloat16)
+        # fp16 needs loss scaling; bf16 has enough exponent range to skip it
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self._use_amp and self.amp_dtype == torch.float16)
+        self.save_every_epoch = save_every_epoch
 
         self.logger.info(
             "ALSTM parameters setting:"
@@ -127,8 +160,17 @@ class ALSTM(Model):
                 torch.mps.manual_seed(self.seed)
             if torch.cuda.is_available():
                 torch.cuda.manual_seed_all(self.seed)
+
+        if torch.cuda.is_available():
+            if self.deterministic:
                 torch.backends.cudnn.deterministic = True
                 torch.backends.cudnn.benchmark = False
+            else:
+                # batch shapes are fixed (drop_last=True), so the autotuner settles
+                # on the fastest RNN kernel after the first step; results may differ
+                # slightly across runs even with a seed
+                torch.backends.cudnn.benchmark = True
+                self.logger.info("cudnn benchmark mode enabled, pass deterministic=True for bitwise reproducibility")
 
         self.ALSTM_model = ALSTMModel(
             d_feat=self.d_feat,
@@ -155,83 +197,132 @@ class ALSTM(Model):
         else:
             self.fitted = False
         self.ALSTM_model.to(self.device)
+        if self.compile:
+            if hasattr(torch, "compile"):
+                # reduce-overhead enables CUDA graphs, which is safe here because
+                # drop_last=True guarantees fixed batch shapes
+                self.ALSTM_model = torch.compile(self.ALSTM_model, mode="reduce-overhead")
+                self.logger.info("model compiled with torch.compile(mode='reduce-overhead')")
+            else:
+                self.logger.warning("torch.compile requires pytorch >= 2.0, running eager")
+        if self.distributed:
+            self.ALSTM_model = nn.parallel.DistributedDataParallel(
+                self.ALSTM_model,
+                device_ids=[self.device.index] if self.device.type == "cuda" else None,
+            )
+        if self.device.type == "cuda":
+            # compact the RNN weights into one chunk so cudnn recognizes the
+            # layout and can select its persistent kernel (automatic for
+            # hidden sizes <= 1024 when dropout is 0)
+            self._raw_model().rnn.flatten_parameters()
 
     @property
     def use_gpu(self):
         return self.device != torch.device("cpu")
 
+    def _autocast(self):
+        if self._use_amp:
+            return torch.autocast(device_type="cuda", dtype=self.amp_dtype)
+        return contextlib.nullcontext()
+
+    def _raw_model(self):
+        # unwrap the DDP container so state_dict keys stay stable across modes
+        if isinstance(self.ALSTM_model, nn.parallel.DistributedDataParallel):
+            return self.ALSTM_model.module
+        return self.ALSTM_model
+
+    def _cpu_state_dict(self):
+        # detached CPU copy of the weights; cheaper than deepcopy on CUDA tensors
+        return {k: v.detach().to("cpu", copy=True, non_blocking=True) for k, v in self._raw_model().state_dict().items()}
+
     def mse(self, pred, label, weight):
-        loss = weight * (pred - label) ** 2
-        return torch.mean(loss)
+        # masked weighted mean; masking via multiply keeps the kernels dense and
+        # avoids the host sync a boolean gather would trigger on CUDA
+        mask = torch.isfinite(label)
+        sq = F.mse_loss(pred, torch.nan_to_num(label), reduction="none")
+        return (sq * weight * mask).sum() / mask.sum().clamp_min(1)
 
     def loss_fn(self, pred, label, weight=None):
-        mask = ~torch.isnan(label)
-
         if weight is None:
             weight = torch.ones_like(label)
 
         if self.loss == "mse":
-            return self.mse(pred[mask], label[mask], weight[mask])
+            return self.mse(pred, label, weight)
 
         raise ValueError("unknown loss `%s`" % self.loss)
 
     def metric_fn(self, pred, label):
-        mask = torch.isfinite(label)
-
         if self.metric in ("", "loss"):
-            return -self.loss_fn(pred[mask], label[mask])
+            return -self.loss_fn(pred, label)
         elif self.metric == "mse":
-            mask = ~torch.isnan(label)
-            weight = torch.ones_like(label)
-            return -self.mse(pred[mask], label[mask], weight[mask])
+            return -self.mse(pred, label, torch.ones_like(label))
 
         raise ValueError("unknown metric `%s`" % self.metric)
 
     def train_epoch(self, data_loader):
         self.ALSTM_model.train()
 
+        # aggregate train loss/score from the training forward itself so fit
+        # does not have to re-run the whole train set through test_epoch
+        total_loss = torch.zeros((), device=self.device)
+        total_score = torch.zeros((), device=self.device)
+        n = 0
+
         for data, weight in data_loader:
-            if self.device == torch.device("mps"):
-                if data.dtype != torch.float32:
-                    data = data.float()
-                if weight.dtype != torch.float32:
-                    weight = weight.float()
-            feature = data[:, :, 0:-1].to(self.device)
-            label = data[:, -1, -1].to(self.device)
+            feature = data[:, :, 0:-1].to(self.device, non_blocking=True)
+            label = data[:, -1, -1].to(self.device, non_blocking=True)
 
-            pred = self.ALSTM_model(feature.float())
-            loss = self.loss_fn(pred, label, weight.to(self.device))
+            with self._autocast():
+                pred = self.ALSTM_model(feature)
+                loss = self.loss_fn(pred, label, weight.to(self.device, non_blocking=True))
 
             self.train_optimizer.zero_grad()
-            loss.backward()
+            self.scaler.scale(loss).backward()
+            self.scaler.unscale_(self.train_optimizer)
             torch.nn.utils.clip_grad_value_(self.ALSTM_model.parameters(), 3.0)
-            self.train_optimizer.step()
+            self.scaler.step(self.train_optimizer)
+            self.scaler.update()
+
+            bs = feature.shape[0]
+            total_loss += loss.detach() * bs
+            with torch.no_grad():
+                total_score += self.metric_fn(pred.detach(), label) * bs
+            n += bs
+
+        # single device sync per epoch instead of one per batch
+        return (total_loss / max(n, 1)).item(), (total_score / max(n, 1)).item()
 
     def test_epoch(self, data_loader):
         self.ALSTM_model.eval()
 
-        scores = []
-        losses = []
+        # streaming on-device accumulators; one host sync after the loop
+        total_loss = torch.zeros((), device=self.device)
+        total_score = torch.zeros((), device=self.device)
+        n = 0
 
         for data, weight in data_loader:
-            if self.device == torch.device("mps"):
-                if data.dtype != torch.float32:
-                    data = data.float()
-                if weight.dtype != torch.float32:
-                    weight = weight.float()
-            feature = data[:, :, 0:-1].to(self.device)
+            feature = data[:, :, 0:-1].to(self.device, non_blocking=True)
             # feature[torch.isnan(feature)] = 0
-            label = data[:, -1, -1].to(self.device)
-
-            with torch.no_grad():
-                pred = self.ALSTM_model(feature.float())
-                loss = self.loss_fn(pred, label, weight.to(self.device))
-                losses.append(loss.item())
+            label = data[:, -1, -1].to(self.device, non_blocking=True)
 
+            with torch.inference_mode(), self._autocast():
+                pred = self.ALSTM_model(feature)
+                loss = self.loss_fn(pred, label, weight.to(self.device, non_blocking=True))
                 score = self.metric_fn(pred, label)
-                scores.append(score.item())
 
-        return np.mean(losses), np.mean(scores)
+            bs = feature.shape[0]
+            total_loss += loss.detach() * bs
+            total_score += score.detach() * bs
+            n += bs
+
+        loss_avg = total_loss / max(n, 1)
+        score_avg = total_score / max(n, 1)
+        if self.distributed:
+            stats = torch.stack([loss_avg, score_avg])
+            dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+            stats /= self._world_size
+            loss_avg, score_avg = stats[0], stats[1]
+        return loss_avg.item(), score_avg.item()
 
     def fit(
         self,
@@ -259,28 +350,39 @@ class ALSTM(Model):
         else:
             raise ValueError("Unsupported reweighter type.")
 
+        train_dataset = ConcatDataset(dl_train, wl_train, dtype=np.float32)
+        train_sampler = (
+            DistributedSampler(train_dataset, shuffle=True, seed=self.seed if self.seed is not None else 0)
+            if self.distributed
+            else None
+        )
+        n_jobs = min(self.n_jobs, os.cpu_count())
+        loader_kwargs = dict(batch_size=self.batch_size, num_workers=n_jobs, drop_last=True, pin_memory=self.use_gpu)
+        if n_jobs > 0:
+            # persistent workers skip the per-epoch fork; prefetch capped at 4
+            # to bound pinned-memory growth
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
         train_loader = DataLoader(
-            ConcatDataset(dl_train, wl_train),
-            batch_size=self.batch_size,
-            shuffle=True,
-            num_workers=self.n_jobs,
-            drop_last=True,
+            train_dataset,
+            shuffle=train_sampler is None,
+            sampler=train_sampler,
             generator = torch.Generator().manual_seed(self.seed) if self.seed is not None else None,
+            **loader_kwargs,
         )
         valid_loader = DataLoader(
-            ConcatDataset(dl_valid, wl_valid),
-            batch_size=self.batch_size,
+            ConcatDataset(dl_valid, wl_valid, dtype=np.float32),
             shuffle=False,
-            num_workers=self.n_jobs,
-            drop_last=True,
+            **loader_kwargs,
         )
 
         save_path = get_or_create_path(save_path, return_dir=True)
         model_save_dir = os.path.join(save_path, "model_ckpt")
         os.makedirs(model_save_dir, exist_ok=True)
-        # 记录 artifact 到 MLflow
+        # 记录 artifact 到 MLflow（多卡时只在 rank 0 记录）
         from qlib.workflow import R
-        recorder = R.get_recorder()
+        recorder = R.get_recorder() if self._rank == 0 else None
+        # checkpoint writes + artifact uploads happen off the training thread
+        io_pool = ThreadPoolExecutor(max_workers=1)
 
         stop_steps = 0
         train_loss = 0
@@ -296,9 +398,10 @@ class ALSTM(Model):
         for step in range(self.n_epochs):
             self.logger.info("Epoch%d:", step)
             self.logger.info("training...")
-            self.train_epoch(train_loader)
+            if train_sampler is not None:
+                train_sampler.set_epoch(step)
+            train_loss, train_score = self.train_epoch(train_loader)
             self.logger.info("evaluating...")
-            train_loss, train_score = self.test_epoch(train_loader)
             val_loss, val_score = self.test_epoch(valid_loader)
             self.logger.info("train %.6f, valid %.6f" % (train_score, val_score))
             evals_result["train"].append(train_score)
@@ -313,29 +416,30 @@ class ALSTM(Model):
                 recorder.log_metrics(step=step, **log_m)
 
             # 每轮保存模型
-            step_model_path = os.path.join(model_save_dir, f"model_{step}_params.pt")
-            torch.save(self.ALSTM_model.state_dict(), step_model_path)
-            if recorder is not None:
-                recorder.log_artifact(step_model_path, artifact_path="models")
+            if self._rank == 0 and self.save_every_epoch:
+                step_model_path = os.path.join(model_save_dir, f"model_{step}_params.pt")
+                io_pool.submit(_save_and_log, self._cpu_state_dict(), step_model_path, recorder)
 
             if val_score > best_score:
                 best_score = val_score
                 stop_steps = 0
                 best_epoch = step
-                best_param = copy.deepcopy(self.ALSTM_model.state_dict())
+                best_param = self._cpu_state_dict()
             else:
                 stop_steps += 1
                 if stop_steps >= self.early_stop:
                     self.logger.info("early stop")
                     break
 
+        io_pool.shutdown(wait=True)
         self.logger.info("best score: %.6lf @ %d" % (best_score, best_epoch))
-        self.ALSTM_model.load_state_dict(best_param)
+        self._raw_model().load_state_dict(best_param)
         # 保存最优模型
-        best_model_path = os.path.join(model_save_dir, f"base_model_params.pt")
-        torch.save(best_param, best_model_path)
-        if recorder is not None:
-            recorder.log_artifact(best_model_path, artifact_path="models")
+        if self._rank == 0:
+            best_model_path = os.path.join(model_save_dir, f"base_model_params.pt")
+            torch.save(best_param, best_model_path)
+            if recorder is not None:
+                recorder.log_artifact(best_model_path, artifact_path="models")
 
         if self.use_gpu:
             torch.cuda.empty_cache()
@@ -346,19 +450,33 @@ class ALSTM(Model):
 
         dl_test = dataset.prepare(segment, col_set=["feature", "label"], data_key=DataHandlerLP.DK_I)
         dl_test.config(fillna_type="ffill+bfill")
-        test_loader = DataLoader(dl_test, batch_size=self.batch_size, num_workers=self.n_jobs)
+        if dl_test.data_arr.dtype != np.float32:
+            # cast at the source once so every batch arrives as float32
+            dl_test.data_arr = dl_test.data_arr.astype(np.float32)
+        n_jobs = min(self.n_jobs, os.cpu_count())
+        loader_kwargs = dict(batch_size=self.batch_size, num_workers=n_jobs, pin_memory=self.use_gpu)
+        if n_jobs > 0:
+            loader_kwargs.update(prefetch_factor=4)
+        test_loader = DataLoader(dl_test, **loader_kwargs)
         self.ALSTM_model.eval()
+        model = self._raw_model()
+        try:
+            # scripting removes the per-batch python dispatch; inference never
+            # needs the autograd path TorchScript cannot handle
+            model = torch.jit.optimize_for_inference(torch.jit.script(model).eval())
+        except Exception as e:
+            self.logger.warning("torch.jit.script failed, predicting eagerly: %s" % e)
+            model = self.ALSTM_model
         preds = []
 
         for data in test_loader:
-            feature = data[:, :, 0:-1].to(self.device)
-
-            with torch.no_grad():
-                pred = self.ALSTM_model(feature.float()).detach().cpu().numpy()
+            feature = data[:, :, 0:-1].to(self.device, non_blocking=True)
 
-            preds.append(pred)
+            with torch.inference_mode(), self._autocast():
+                preds.append(model(feature).float())
 
-        return pd.Series(np.concatenate(preds), index=dl_test.get_index())
+        # one D2H transfer at the end instead of a blocking copy per batch
+        return pd.Series(torch.cat(preds).cpu().numpy(), index=dl_test.get_index())
 
 
 class ALSTMModel(nn.Module):
@@ -387,25 +505,28 @@ class ALSTMModel(nn.Module):
             dropout=self.dropout,
         )
         self.fc_out = nn.Linear(in_features=self.hid_size * 2, out_features=1)
+        half_hid_size = self.hid_size // 2
         self.att_net = nn.Sequential()
         self.att_net.add_module(
             "att_fc_in",
-            nn.Linear(in_features=self.hid_size, out_features=int(self.hid_size / 2)),
+            nn.Linear(in_features=self.hid_size, out_features=half_hid_size),
         )
         self.att_net.add_module("att_dropout", torch.nn.Dropout(self.dropout))
         self.att_net.add_module("att_act", nn.Tanh())
         self.att_net.add_module(
             "att_fc_out",
-            nn.Linear(in_features=int(self.hid_size / 2), out_features=1, bias=False),
+            nn.Linear(in_features=half_hid_size, out_features=1, bias=False),
         )
-        self.att_net.add_module("att_softmax", nn.Softmax(dim=1))
+        # softmax is applied in forward so it can fuse with the weighted sum
 
     def forward(self, inputs):
+        inputs = inputs.contiguous()  # the feature slice upstream is a strided view; cudnn wants dense input
         rnn_out, _ = self.rnn(self.net(inputs))  # [batch, seq_len, num_directions * hidden_size]
-        attention_score = self.att_net(rnn_out)  # [batch, seq_len, 1]
-        out_att = torch.mul(rnn_out, attention_score)
-        out_att = torch.sum(out_att, dim=1)
+        last_out = rnn_out[:, -1, :]
+        attention_score = F.softmax(self.att_net(rnn_out).squeeze(-1), dim=1)  # [batch, seq_len]
+        # single pass over rnn_out instead of a broadcast mul + separate reduction
+        out_att = torch.einsum("bt,bth->bh", attention_score, rnn_out)
         out = self.fc_out(
-            torch.cat((rnn_out[:, -1, :], out_att), dim=1)
+            torch.cat((last_out, out_att), dim=1)
         )  # [batch, seq_len, num_directions * hidden_size] -> [batch, 1]
         return out[..., 0]
@@ -3,15 +3,19 @@
 
 from __future__ import division
 from __future__ import print_function
-import copy
+import contextlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Text, Union
 
 import numpy as np
 import pandas as pd
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.data import DataLoader, DistributedSampler, TensorDataset
 
 from qlib.workflow import R
 
@@ -23,6 +27,12 @@ from ...utils import get_or_create_path
 from .pytorch_utils import count_parameters
 
 
+def _save_and_log(state_dict, path, recorder):
+    torch.save(state_dict, path)
+    if recorder is not None:
+        recorder.log_artifact(path, artifact_path="models")
+
+
 class GRU(Model):
     """GRU Model
 
@@ -52,7 +62,12 @@ class GRU(Model):
         loss="mse",
         optimizer="adam",
         GPU=0,
+        distributed=False,
         seed=None,
+        deterministic=False,
+        compile=False,
+        amp_dtype="bfloat16",
+        save_every_epoch=False,
         init_model_path=None,
         **kwargs,
     ):
@@ -73,7 +88,26 @@ class GRU(Model):
         self.optimizer = optimizer.lower()
         self.loss = loss
         self.device = torch.device("cuda:%d" % (GPU) if torch.cuda.is_available() and GPU >= 0 else "mps" if torch.backends.mps.is_available() else "cpu")
+        self.distributed = distributed
+        self._rank, self._world_size = 0, 1
+        if self.distributed:
+            # launched via torchrun; one process per GPU
+            if not dist.is_initialized():
+                dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+            self._rank = dist.get_rank()
+            self._world_size = dist.get_world_size()
+            if torch.cuda.is_available():
+                local_rank = int(os.environ.get("LOCAL_RANK", self._rank))
+                torch.cuda.set_device(local_rank)
+                self.device = torch.device("cuda:%d" % local_rank)
         self.seed = seed
+        self.deterministic = deterministic
+        self.compile = compile
+        self.amp_dtype = getattr(torch, amp_dtype) if isinstance(amp_dtype, str) else amp_dtype
+        self._use_amp = self.device.type == "cuda" and self.amp_dtype in (torch.float16, torch.bfloat16)
+        # fp16 needs loss scaling; bf16 has enough exponent range to skip it
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self._use_amp and self.amp_dtype == torch.float16)
+        self.save_every_epoch = save_every_epoch
 
         self.logger.info(
             "GRU parameters setting:"
@@ -115,8 +149,17 @@ class GRU(Model):
                 torch.mps.manual_seed(self.seed)
             if torch.cuda.is_available():
                 torch.cuda.manual_seed_all(self.seed)
+
+        if torch.cuda.is_available():
+            if self.deterministic:
                 torch.backends.cudnn.deterministic = True
                 torch.backends.cudnn.benchmark = False
+            else:
+                # batch size, seq_len and hidden size are constant across iterations,
+                # so cudnn autotuning converges after the first step; results may
+                # differ slightly across runs even with a seed
+                torch.backends.cudnn.benchmark = True
+                self.logger.info("cudnn benchmark mode enabled, pass deterministic=True for bitwise reproducibility")
 
         self.gru_model = GRUModel(
             d_feat=self.d_feat,
@@ -143,83 +186,118 @@ class GRU(Model):
         else:
             self.fitted = False
         self.gru_model.to(self.device)
+        if self.compile:
+            if hasattr(torch, "compile"):
+                # reduce-overhead enables CUDA graphs; batch shapes are constant
+                # in the training loop so no re-capture is triggered
+                self.gru_model = torch.compile(self.gru_model, mode="reduce-overhead")
+                self.logger.info("model compiled with torch.compile(mode='reduce-overhead')")
+            else:
+                self.logger.warning("torch.compile requires pytorch >= 2.0, running eager")
+        if self.distributed:
+            self.gru_model = nn.parallel.DistributedDataParallel(
+                self.gru_model,
+                device_ids=[self.device.index] if self.device.type == "cuda" else None,
+            )
+        if self.device.type == "cuda":
+            # compact the RNN weights into one chunk so cudnn recognizes the
+            # layout and can select its persistent kernel (automatic for
+            # hidden sizes <= 1024 when dropout is 0)
+            self._raw_model().rnn.flatten_parameters()
 
     @property
     def use_gpu(self):
         return self.device != torch.device("cpu")
 
+    def _autocast(self):
+        if self._use_amp:
+            return torch.autocast(device_type="cuda", dtype=self.amp_dtype)
+        return contextlib.nullcontext()
+
+    def _raw_model(self):
+        # unwrap the DDP container so state_dict keys stay stable across modes
+        if isinstance(self.gru_model, nn.parallel.DistributedDataParallel):
+            return self.gru_model.module
+        return self.gru_model
+
+    def _cpu_state_dict(self):
+        # detached CPU copy of the weights; cheaper than deepcopy on CUDA tensors
+        return {k: v.detach().to("cpu", copy=True, non_blocking=True) for k, v in self._raw_model().state_dict().items()}
+
+    def _to_device(self, tensor):
+        # pin + async copy overlaps the H2D DMA with compute on CUDA;
+        # plain copy elsewhere to avoid pinned-memory issues on CPU/MPS runs
+        if self.device.type == "cuda":
+            return tensor.pin_memory().to(self.device, non_blocking=True)
+        return tensor.to(self.device)
+
     def mse(self, pred, label):
-        loss = (pred - label) ** 2
-        return torch.mean(loss)
+        # masked mean; masking via multiply keeps the kernels dense and avoids
+        # the host sync a boolean gather would trigger on CUDA
+        mask = torch.isfinite(label)
+        sq = F.mse_loss(pred, torch.nan_to_num(label), reduction="none")
+        return (sq * mask).sum() / mask.sum().clamp_min(1)
 
     def loss_fn(self, pred, label):
-        mask = ~torch.isnan(label)
-
         if self.loss == "mse":
-            return self.mse(pred[mask], label[mask])
+            return self.mse(pred, label)
 
         raise ValueError("unknown loss `%s`" % self.loss)
 
     def metric_fn(self, pred, label):
-        mask = torch.isfinite(label)
-
         if self.metric in ("", "loss"):
-            return -self.loss_fn(pred[mask], label[mask])
+            return -self.loss_fn(pred, label)
 
         raise ValueError("unknown metric `%s`" % self.metric)
 
-    def train_epoch(self, x_train, y_train):
-        x_train_values = x_train.values
-        y_train_values = np.squeeze(y_train.values)
-
+    def train_epoch(self, data_loader):
         self.gru_model.train()
 
-        indices = np.arange(len(x_train_values))
-        np.random.shuffle(indices)
-
-        for i in range(len(indices))[:: self.batch_size]:
-            if len(indices) - i < self.batch_size:
-                break
-
-            feature = torch.from_numpy(x_train_values[indices[i : i + self.batch_size]]).float().to(self.device)
-            label = torch.from_numpy(y_train_values[indices[i : i + self.batch_size]]).float().to(self.device)
+        for feature, label in data_loader:
+            feature = feature.to(self.device, non_blocking=True)
+            label = label.to(self.device, non_blocking=True)
 
-            pred = self.gru_model(feature)
-            loss = self.loss_fn(pred, label)
+            with self._autocast():
+                pred = self.gru_model(feature)
+                loss = self.loss_fn(pred, label)
 
             self.train_optimizer.zero_grad()
-            loss.backward()
+            self.scaler.scale(loss).backward()
+            self.scaler.unscale_(self.train_optimizer)
             torch.nn.utils.clip_grad_value_(self.gru_model.parameters(), 3.0)
-            self.train_optimizer.step()
-
-    def test_epoch(self, data_x, data_y):
-        # prepare training data
-        x_values = data_x.values
-        y_values = np.squeeze(data_y.values)
+            self.scaler.step(self.train_optimizer)
+            self.scaler.update()
 
+    def test_epoch(self, data_loader):
         self.gru_model.eval()
 
-        scores = []
-        losses = []
-
-        indices = np.arange(len(x_values))
-
-        for i in range(len(indices))[:: self.batch_size]:
-            if len(indices) - i < self.batch_size:
-                break
+        # streaming on-device accumulators; one host sync after the loop
+        total_loss = torch.zeros((), device=self.device)
+        total_score = torch.zeros((), device=self.device)
+        n = 0
 
-            feature = torch.from_numpy(x_values[indices[i : i + self.batch_size]]).float().to(self.device)
-            label = torch.from_numpy(y_values[indices[i : i + self.batch_size]]).float().to(self.device)
+        for feature, label in data_loader:
+            feature = feature.to(self.device, non_blocking=True)
+            label = label.to(self.device, non_blocking=True)
 
-            with torch.no_grad():
+            with torch.inference_mode(), self._autocast():
                 pred = self.gru_model(feature)
                 loss = self.loss_fn(pred, label)
-                losses.append(loss.item())
-
                 score = self.metric_fn(pred, label)
-                scores.append(score.item())
 
-        return np.mean(losses), np.mean(scores)
+            bs = feature.shape[0]
+            total_loss += loss.detach() * bs
+            total_score += score.detach() * bs
+            n += bs
+
+        loss_avg = total_loss / max(n, 1)
+        score_avg = total_score / max(n, 1)
+        if self.distributed:
+            stats = torch.stack([loss_avg, score_avg])
+            dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+            stats /= self._world_size
+            loss_avg, score_avg = stats[0], stats[1]
+        return loss_avg.item(), score_avg.item()
 
     def fit(
         self,
@@ -255,12 +333,46 @@ class GRU(Model):
         else:
             x_valid, y_valid = None, None
 
+        # cast + compact in numpy so the tensors are built in one copy and
+        # shared with the loader workers for the whole fit
+        train_dataset = TensorDataset(
+            torch.from_numpy(np.ascontiguousarray(x_train.values, dtype=np.float32)),
+            torch.from_numpy(np.ascontiguousarray(np.squeeze(y_train.values), dtype=np.float32)),
+        )
+        train_sampler = (
+            DistributedSampler(train_dataset, shuffle=True, seed=self.seed if self.seed is not None else 0)
+            if self.distributed
+            else None
+        )
+        n_jobs = self.kwargs.get("n_jobs", 4)
+        loader_kwargs = dict(batch_size=self.batch_size, num_workers=n_jobs, drop_last=True, pin_memory=self.use_gpu)
+        if n_jobs > 0:
+            # persistent workers avoid the per-epoch fork cost that dominates short epochs
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+        train_loader = DataLoader(
+            train_dataset,
+            shuffle=train_sampler is None,
+            sampler=train_sampler,
+            generator=torch.Generator().manual_seed(self.seed) if self.seed is not None else None,
+            **loader_kwargs,
+        )
+
+        valid_loader = None
+        if x_valid is not None:
+            valid_dataset = TensorDataset(
+                torch.from_numpy(np.ascontiguousarray(x_valid.values, dtype=np.float32)),
+                torch.from_numpy(np.ascontiguousarray(np.squeeze(y_valid.values), dtype=np.float32)),
+            )
+            valid_loader = DataLoader(valid_dataset, shuffle=False, **loader_kwargs)
+
         save_path = get_or_create_path(save_path, return_dir=True)
         model_save_dir = os.path.join(save_path, "model_ckpt")
         os.makedirs(model_save_dir, exist_ok=True)
-        # 记录 artifact 到 MLflow
+        # 记录 artifact 到 MLflow（多卡时只在 rank 0 记录）
         from qlib.workflow import R
-        recorder = R.get_recorder()
+        recorder = R.get_recorder() if self._rank == 0 else None
+        # checkpoint writes + artifact uploads happen off the training thread
+        io_pool = ThreadPoolExecutor(max_workers=1)
 
         stop_steps = 0
         train_loss = 0
@@ -273,24 +385,25 @@ class GRU(Model):
         self.logger.info("training...")
         self.fitted = True
 
-        best_param = copy.deepcopy(self.gru_model.state_dict())
+        best_param = self._cpu_state_dict()
         for step in range(self.n_epochs):
             self.logger.info("Epoch%d:", step)
             self.logger.info("training...")
-            self.train_epoch(x_train, y_train)
+            if train_sampler is not None:
+                train_sampler.set_epoch(step)
+            self.train_epoch(train_loader)
             self.logger.info("evaluating...")
-            train_loss, train_score = self.test_epoch(x_train, y_train)
+            train_loss, train_score = self.test_epoch(train_loader)
             evals_result["train"].append(train_score)
 
             # 每轮保存模型
-            step_model_path = os.path.join(model_save_dir, f"model_{step}_params.pt")
-            torch.save(self.gru_model.state_dict(), step_model_path)
-            if recorder is not None:
-                recorder.log_artifact(step_model_path, artifact_path="models")
+            if self._rank == 0 and self.save_every_epoch:
+                step_model_path = os.path.join(model_save_dir, f"model_{step}_params.pt")
+                io_pool.submit(_save_and_log, self._cpu_state_dict(), step_model_path, recorder)
 
             # evaluate on validation data if provided
-            if x_valid is not None and y_valid is not None:
-                val_loss, val_score = self.test_epoch(x_valid, y_valid)
+            if valid_loader is not None:
+                val_loss, val_score = self.test_epoch(valid_loader)
                 self.logger.info("train %.6f, valid %.6f" % (train_score, val_score))
                 evals_result["valid"].append(val_score)
 
@@ -298,26 +411,28 @@ class GRU(Model):
                     best_score = val_score
                     stop_steps = 0
                     best_epoch = step
-                    best_param = copy.deepcopy(self.gru_model.state_dict())
+                    best_param = self._cpu_state_dict()
                 else:
                     stop_steps += 1
                     if stop_steps >= self.early_stop:
                         self.logger.info("early stop")
                         break
 
+        io_pool.shutdown(wait=True)
         self.logger.info("best score: %.6lf @ %d" % (best_score, best_epoch))
-        self.gru_model.load_state_dict(best_param)
+        self._raw_model().load_state_dict(best_param)
         # 保存最优模型
-        best_model_path = os.path.join(model_save_dir, f"base_model_params.pt")
-        torch.save(best_param, best_model_path)
-        if recorder is not None:
-            recorder.log_artifact(best_model_path, artifact_path="models")
+        if self._rank == 0:
+            best_model_path = os.path.join(model_save_dir, f"base_model_params.pt")
+            torch.save(best_param, best_model_path)
+            if recorder is not None:
+                recorder.log_artifact(best_model_path, artifact_path="models")
 
         # Logging
-        rec = R.get_recorder()
-        for k, v_l in evals_result.items():
-            for i, v in enumerate(v_l):
-                rec.log_metrics(step=i, **{k: v})
+        if recorder is not None:
+            for k, v_l in evals_result.items():
+                for i, v in enumerate(v_l):
+                    recorder.log_metrics(step=i, **{k: v})
 
         if self.use_gpu:
             torch.cuda.empty_cache()
@@ -329,7 +444,16 @@ class GRU(Model):
         x_test = dataset.prepare(segment, col_set="feature", data_key=DataHandlerLP.DK_I)
         index = x_test.index
         self.gru_model.eval()
-        x_values = x_test.values
+        model = self._raw_model()
+        try:
+            # scripting removes the per-batch python dispatch; inference never
+            # needs the autograd path TorchScript cannot handle
+            model = torch.jit.optimize_for_inference(torch.jit.script(model).eval())
+        except Exception as e:
+            self.logger.warning("torch.jit.script failed, predicting eagerly: %s" % e)
+            model = self.gru_model
+        # cast at the source once so every batch arrives as float32
+        x_values = np.ascontiguousarray(x_test.values, dtype=np.float32)
         sample_num = x_values.shape[0]
         preds = []
 
@@ -339,14 +463,13 @@ class GRU(Model):
             else:
                 end = begin + self.batch_size
 
-            x_batch = torch.from_numpy(x_values[begin:end]).float().to(self.device)
-
-            with torch.no_grad():
-                pred = self.gru_model(x_batch).detach().cpu().numpy()
+            x_batch = self._to_device(torch.from_numpy(x_values[begin:end]))
 
-            preds.append(pred)
+            with torch.inference_mode(), self._autocast():
+                preds.append(model(x_batch).float())
 
-        return pd.Series(np.concatenate(preds), index=index)
+        # one D2H transfer at the end instead of a blocking copy per batch
+        return pd.Series(torch.cat(preds).cpu().numpy(), index=index)
 
 
 class GRUModel(nn.Module):
@@ -366,7 +489,7 @@ class GRUModel(nn.Module):
 
     def forward(self, x):
         # x: [N, F*T]
-        x = x.reshape(len(x), self.d_feat, -1)  # [N, F, T]
+        x = x.reshape(x.shape[0], self.d_feat, -1)  # [N, F, T]
         x = x.permute(0, 2, 1)  # [N, T, F]
         out, _ = self.rnn(x)
         return self.fc_out(out[:, -1, :]).squeeze()
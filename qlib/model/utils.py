@@ -1,15 +1,21 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import numpy as np
 from torch.utils.data import Dataset
 
 
 class ConcatDataset(Dataset):
-    def __init__(self, *datasets):
+    def __init__(self, *datasets, dtype=None):
+        # when `dtype` is given, samples are cast once here (in the loader
+        # workers) instead of per batch in the training loop
         self.datasets = datasets
+        self.dtype = dtype
 
     def __getitem__(self, i):
-        return tuple(d[i] for d in self.datasets)
+        if self.dtype is None:
+            return tuple(d[i] for d in self.datasets)
+        return tuple(np.asarray(d[i], dtype=self.dtype) for d in self.datasets)
 
     def __len__(self):
         return min(len(d) for d in self.datasets)